@@ -41,6 +41,9 @@
 #
 # NOTE: This script requires Python to be installed on your system.
 #
+# NOTE: If the unrar library (libunrar.so or unrar.dll) is installed it is used
+# to read archive headers directly, otherwise unrar is called for each file.
+#
 ##############################################################################
 ### OPTIONS                                                                ###
 
@@ -57,6 +60,12 @@
 #
 #PassAction=Pause
 
+# Time limit for testing a single file (seconds).
+#
+# If unrar doesn't finish in time the file is skipped and tested again
+# on the next event. Not supported with Python 2.
+#ProbeTimeout=30
+
 ### NZBGET QUEUE/POST-PROCESSING SCRIPT                                    ###
 ##############################################################################
 from __future__ import absolute_import
@@ -65,7 +74,13 @@ import os
 import sys
 import subprocess
 import re
+import json
+import functools
+import ctypes
+import ctypes.util
 import requests
+from requests.adapters import HTTPAdapter
+import threading
 import traceback
 
 PY2 = 2 == sys.version_info[0]
@@ -74,14 +89,31 @@ PY3 = 3 == sys.version_info[0]
 if PY3:
 	text_type = str
 	binary_type = bytes
+	TimeoutExpired = subprocess.TimeoutExpired
 
 else:
 	text_type = unicode
 	binary_type = str
+	# Python 2 runs unrar without timeout
+	TimeoutExpired = ()
+	# os.cpu_count isn't available in Python 2
+	import multiprocessing
 
 from xmlrpclib_to import ServerProxy
 import shlex
 
+try:
+	from concurrent import futures
+except ImportError:
+	# Python 2 without "futures" backport, files are tested one after another
+	futures = None
+
+try:
+	from os import scandir
+except ImportError:
+	# Python 2, folders are listed with os.listdir
+	scandir = None
+
 # Exit codes used by NZBGet
 POSTPROCESS_SUCCESS = 93
 POSTPROCESS_NONE = 95
@@ -95,6 +127,70 @@ verbose = False
 # Strings to check if rar is password protected (comma separated list)
 PasswordStrings = '*,wrong password,The specified password is incorrect,encrypted headers,Incorrect password for'
 
+# "PasswordStrings" compiled into a single case insensitive pattern, None if the list is blank.
+# The pattern is matched against raw unrar output (bytes), the strings are pure ASCII.
+password_patterns = [re.escape(m_string.strip().encode('ascii')) for m_string in PasswordStrings.split(',') if m_string.strip()]
+password_regex = re.compile(b'|'.join(password_patterns), re.IGNORECASE) if password_patterns else None
+
+# Line breaks in unrar output, joined into one line for logging
+line_breaks_regex = re.compile(r'[\r\n]+')
+
+# Names of rar-files (".rar", ".partXX.rar", ".rXX"); other files are checked for rar signature
+rar_ext_regex = re.compile(r'\.(?:rar|r\d{2,3})$', re.IGNORECASE)
+RAR_SIGNATURE = b'Rar!\x1a\x07'
+
+# Volume number XX of rar-files named ".partXX.rar" or ".rXX"
+rar_num_regex = re.compile(r'.*(?:\.part(?P<part>\d+)\.rar|\.r(?P<r>\d+))$', re.IGNORECASE)
+
+# Line prefixes of json-rpc fields read by the fallback parsers
+ID_PREFIX = '"ID" : '
+FILENAME_PREFIX = '"Filename" : "'
+NZBID_PREFIX = '"NZBID" : '
+
+# Constants and structures of the unrar library API (see dll.hpp of unrar sources)
+RAR_OM_LIST = 0
+RAR_SKIP = 0
+ERAR_SUCCESS = 0
+ERAR_MISSING_PASSWORD = 22
+ERAR_BAD_PASSWORD = 24
+ROADF_ENCHEADERS = 0x0080
+RHDF_ENCRYPTED = 0x0004
+
+# Exit code of unrar executable if archive requires a password (RARX_BADPWD)
+RARX_BADPWD = 11
+
+
+class RAROpenArchiveDataEx(ctypes.Structure):
+	_fields_ = [
+		('ArcName', ctypes.c_char_p),
+		('ArcNameW', ctypes.c_wchar_p),
+		('OpenMode', ctypes.c_uint),
+		('OpenResult', ctypes.c_uint),
+		('CmtBuf', ctypes.c_char_p),
+		('CmtBufSize', ctypes.c_uint),
+		('CmtSize', ctypes.c_uint),
+		('CmtState', ctypes.c_uint),
+		('Flags', ctypes.c_uint),
+		('Callback', ctypes.c_void_p),
+		('UserData', ctypes.c_void_p),
+		('OpFlags', ctypes.c_uint),
+		('CmtBufW', ctypes.c_wchar_p),
+		('MarkOfTheWeb', ctypes.c_wchar_p),
+		('Reserved', ctypes.c_uint * 32),
+	]
+
+
+class RARHeaderDataEx(ctypes.Structure):
+	# Only "Flags" is inspected; the tail is padding large enough for any library version
+	_fields_ = [
+		('ArcName', ctypes.c_char * 1024),
+		('ArcNameW', ctypes.c_wchar * 1024),
+		('FileName', ctypes.c_char * 1024),
+		('FileNameW', ctypes.c_wchar * 1024),
+		('Flags', ctypes.c_uint),
+		('Reserved', ctypes.c_uint * 4096),
+	]
+
 
 def ensure_str(s, encoding='utf-8', errors='strict'):
 	"""Coerce *s* to `str`.
@@ -120,7 +216,7 @@ def ensure_str(s, encoding='utf-8', errors='strict'):
 
 
 # Start up checks
-def start_check():
+def start_check(temp_folder):
 	# Check if the script is called from a compatible NZBGet version (as queue-script or as pp-script)
 	if not ('NZBNA_EVENT' in os.environ or 'NZBPP_DIRECTORY' in os.environ) or 'NZBOP_ARTICLECACHE' not in os.environ:
 		print('*** NZBGet queue script ***')
@@ -138,32 +234,32 @@ def start_check():
 			# Print the message again during post-processing to add it into the post-processing log
 			# (which is then can be used by notification scripts such as EMail.py)
 			print('[WARNING] Download is password protected')
-		clean_up()
+		clean_up(temp_folder)
 		sys.exit(POSTPROCESS_SUCCESS)
 
 	# Check if password previously found
 	if os.environ.get('NZBPR_PASSWORDDETECTOR_HASPASSWORD') == 'yes':
 		print('[DETAIL] Password previously found, skipping detection')
 		if 'NZBPP_DIRECTORY' in os.environ:
-			clean_up()  # PProcessing, clean_up
+			clean_up(temp_folder)  # PProcessing, clean_up
 		sys.exit(POSTPROCESS_SUCCESS)
 
 	# Check if a previous scan script or user via web ui has defined a password
 	if 'NZBPR_*Unpack:Password' in os.environ:
 		print('[DETAIL] Password previously defined, skipping detection')
 		if 'NZBPP_DIRECTORY' in os.environ:
-			clean_up()  # PProcessing, clean_up
+			clean_up(temp_folder)  # PProcessing, clean_up
 		sys.exit(POSTPROCESS_SUCCESS)
 		
 	# If called via "Post-process again" from history details dialog the download may not exist anymore
 	if 'NZBPP_DIRECTORY' in os.environ and not os.path.exists(os.environ.get('NZBPP_DIRECTORY')):
 		print('Destination directory doesn\'t exist, exiting')
-		clean_up()
+		clean_up(temp_folder)
 		sys.exit(POSTPROCESS_NONE)
 
 	# If nzb is already failed, don't do any further detection
 	if os.environ.get('NZBPP_TOTALSTATUS') == 'FAILURE':
-		clean_up()
+		clean_up(temp_folder)
 		sys.exit(POSTPROCESS_NONE)
 	
 	# Check settings
@@ -173,61 +269,110 @@ def start_check():
 		sys.exit(POSTPROCESS_ERROR)
 
 
-# Check if the verbose logging option is enabled
-def check_verbose_logging():
-	if verbose:
-		return True
-	return False
-
-
-# Check the "PASSWORDSTRINGS" against archive output
+# Check the "PASSWORDSTRINGS" against archive output (bytes)
 def check_passwordstrings(outtext, errtext):
-	if check_verbose_logging():
-		if len(outtext) > 0:
-			print("out: " + outtext.translate(None, '\r\n'))
-		if len(errtext) > 0:
-			print("error: " + errtext.translate(None, '\r\n'))
+	if verbose and outtext:
+		print("out: " + line_breaks_regex.sub(' ', ensure_str(outtext, errors='replace')))
+	if verbose and errtext:
+		print("error: " + line_breaks_regex.sub(' ', ensure_str(errtext, errors='replace')))
 
-	PasswordString = PasswordStrings.split(',')
-	
 	# must not be blank
-	if PasswordString == [] or PasswordString == ['']:
+	if password_regex is None:
 		return False
 
-	for m_string in PasswordString:
-		m_string = m_string.strip().lower()
-		if m_string != '':
-			if m_string in outtext.lower():
-				return True
-			if m_string in errtext.lower():
-				return True
-	return False
+	return bool(password_regex.search(outtext) or password_regex.search(errtext))
 
 
-# Finds untested files, comparing all files and processed files in tmp_file
-def get_latest_file(dir_name):
+# Reads processed files from tmp_file as dict: file name -> [mtime, size] when tested
+def load_tested(tmp_file_name):
 	try:
 		with open(tmp_file_name) as tmp_file:
-			tested = tmp_file.read().splitlines()
-			files = os.listdir(dir_name)
-			return list(set(files)-set(tested))
-	except:
+			tested = json.load(tmp_file)
+		# tmp_file of an older version may be decoded as a number or string
+		return tested if isinstance(tested, dict) else {}
+	except ValueError:
+		# tmp_file of an older version (list of names), test all files again
+		return {}
+	except (IOError, OSError):
 		# tmp_file doesn't exist, all files need testing
 		temp_folder = os.path.dirname(tmp_file_name)
 		if not os.path.exists(temp_folder):
 			os.makedirs(temp_folder)
 			print('[DETAIL] Created folder ' + temp_folder)
-		with open(tmp_file_name, "w") as tmp_file:
-			tmp_file.write('')
-			print('[DETAIL] Created temp file ' + tmp_file_name)
-		return os.listdir(dir_name)
+		return {}
+
+
+# Lists regular files in folder as (name, path, stat) tuples, where stat is
+# the function returning the (cached with os.scandir) stat of the file
+def list_files(dir_name):
+	if scandir is None:
+		paths = ((file, os.path.join(dir_name, file)) for file in os.listdir(dir_name))
+		return [(file, file_path, functools.partial(os.stat, file_path)) for file, file_path in paths
+			if os.path.isfile(file_path)]
+	return [(entry.name, entry.path, entry.stat) for entry in scandir(dir_name) if entry.is_file()]
+
+
+# Key of a file in the dict of tested files. Python 2 lists names as bytes but
+# json returns unicode; the bytes are mapped one to one (latin-1) so that every
+# name, even if not valid in the filesystem encoding, round trips through tmp_file.
+def tested_key(file):
+	if PY2 and isinstance(file, binary_type):
+		return file.decode('latin-1')
+	return file
+
+
+# Finds untested files, comparing all files and processed files.
+# Files which were changed since they were tested (mtime or size) are tested again.
+# Entries of files no longer in the folder are removed from tested.
+# Returns (name, path, [mtime, size]) for each file
+def get_latest_file(dir_name, tested):
+	files = []
+	listed = set()
+	for file, file_path, file_stat in list_files(dir_name):
+		# avoid .tmp files as corrupt, NZBGet renames them once complete
+		if "tmp" in file:
+			continue
+		try:
+			stat = file_stat()
+		except OSError:
+			# File was renamed or deleted in the meantime
+			continue
+		key = tested_key(file)
+		listed.add(key)
+		signature = [stat.st_mtime, stat.st_size]
+		if tested.get(key) != signature:
+			files.append((file, file_path, signature))
+	for key in [key for key in tested if key not in listed]:
+		del tested[key]
+	return files
+
+
+# Replaces file dst with src in one step (os.replace isn't available in Python 2)
+def replace_file(src, dst):
+	if PY3:
+		os.replace(src, dst)
+		return
+	if os.name == 'nt' and os.path.exists(dst):
+		os.remove(dst)
+	os.rename(src, dst)
 
 
 # Saves tested files so to not test again
-def save_tested(data):
-	with open(tmp_file_name, "a") as tmp_file:
-		tmp_file.write(data)
-		
+# Failing to save only costs re-testing on the next event, so errors are logged, not raised.
+def save_tested(tmp_file_name, tested):
+	new_file_name = tmp_file_name + '.tmp'
+	try:
+		with open(new_file_name, "w") as tmp_file:
+			json.dump(tested, tmp_file)
+		replace_file(new_file_name, tmp_file_name)
+	except (IOError, OSError, ValueError) as e:
+		print('[ERROR] Could not save tested files to %s: %s' % (tmp_file_name, e))
+		try:
+			os.remove(new_file_name)
+		except OSError:
+			pass
+
+
 # Extract path to unrar from NZBGet's global option "UnrarCmd";
 # Since v15 "UnrarCmd" may contain extra parameters passed to unrar;
 # We have to strip these parameters because we need only the path to unrar.
@@ -246,30 +391,214 @@ def unrar():
 	# We were unable to determine the path to unrar;
 	# Let's use the exe name with a hope it's in the search path
 	return exe_name
-	
 
-# Checks files for passwords without unpacking
-def contains_password(dir_name):
-	files = get_latest_file(dir_name)
-	tested = ''
-	for file in files:
-		# avoid .tmp files as corrupt
-		if "tmp" not in file:
-			try:
-				command = [unrar(), 'l', '-p-', '-c-', dir_name + '/' + file]
-				if check_verbose_logging():
-					print('command: %s' % command)
-				proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-				out, err = proc.communicate()
-				out, err = ensure_str(out), ensure_str(err)
-				if check_passwordstrings(out, err):
-					return True
-			except Exception as e:
-				print('[ERROR] Failed %s: %s' % (file, e))
+
+# Load the unrar library (libunrar.so or unrar.dll) if it is installed.
+# Returns None if the library isn't available, unrar executable is used then.
+def load_unrar_lib():
+	lib_name = ctypes.util.find_library('unrar')
+	if not lib_name:
+		return None
+	try:
+		lib = ctypes.WinDLL(lib_name) if os.name == 'nt' else ctypes.CDLL(lib_name)
+	except OSError:
+		return None
+	lib.RAROpenArchiveEx.argtypes = [ctypes.POINTER(RAROpenArchiveDataEx)]
+	lib.RAROpenArchiveEx.restype = ctypes.c_void_p
+	lib.RARReadHeaderEx.argtypes = [ctypes.c_void_p, ctypes.POINTER(RARHeaderDataEx)]
+	lib.RARReadHeaderEx.restype = ctypes.c_int
+	lib.RARProcessFile.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_char_p]
+	lib.RARProcessFile.restype = ctypes.c_int
+	lib.RARCloseArchive.argtypes = [ctypes.c_void_p]
+	lib.RARCloseArchive.restype = ctypes.c_int
+	print('[DETAIL] Using unrar library %s to read archive headers, option UnrarCmd is not used' % lib_name)
+	return lib
+
+
+# Checks archive headers for encryption flags via unrar library, no output parsing needed
+def lib_contains_password(lib, file_path):
+	data = RAROpenArchiveDataEx()
+	if isinstance(file_path, text_type):
+		data.ArcNameW = file_path
+	else:
+		data.ArcName = file_path
+	data.OpenMode = RAR_OM_LIST
+	handle = lib.RAROpenArchiveEx(ctypes.byref(data))
+	if verbose:
+		print('open: %s, result: %i, flags: 0x%04x' % (file_path, data.OpenResult, data.Flags))
+	if not handle:
+		return data.OpenResult in (ERAR_MISSING_PASSWORD, ERAR_BAD_PASSWORD)
+	try:
+		if data.Flags & ROADF_ENCHEADERS:
+			return True
+		header = RARHeaderDataEx()
+		while True:
+			result = lib.RARReadHeaderEx(handle, ctypes.byref(header))
+			if result != ERAR_SUCCESS:
 				if verbose:
-					traceback.print_exc() 
-		tested += file + '\n'
-	save_tested(tested)
+					print('header result: %i' % result)
+				# End of archive or broken (incomplete) archive
+				return result in (ERAR_MISSING_PASSWORD, ERAR_BAD_PASSWORD)
+			if verbose:
+				print('header: %s, flags: 0x%04x' % (ensure_str(header.FileName, errors='replace'), header.Flags))
+			if header.Flags & RHDF_ENCRYPTED:
+				return True
+			if lib.RARProcessFile(handle, RAR_SKIP, None, None) != ERAR_SUCCESS:
+				return False
+	finally:
+		lib.RARCloseArchive(handle)
+
+
+# Runs unrar for the probes. Running processes are remembered so that
+# they can be killed once a password is found.
+class UnrarRunner(object):
+
+	def __init__(self, command_base, timeout):
+		self.command_base = command_base
+		self.timeout = timeout
+		self.procs = set()
+		self.lock = threading.Lock()
+		self.stopped = False
+
+	# Runs unrar with closed stdin so it can never wait for input, returns exit code and output.
+	# Raises TimeoutExpired if unrar doesn't finish within timeout seconds.
+	def run(self, file_path):
+		command = self.command_base + [file_path]
+		if verbose:
+			print('command: %s' % command)
+		with open(os.devnull, 'rb') as devnull:
+			with self.lock:
+				if self.stopped:
+					# Password already found, result isn't used anymore
+					return None, b'', b''
+				proc = subprocess.Popen(command, stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+				self.procs.add(proc)
+			try:
+				if PY2:
+					out, err = proc.communicate()
+				else:
+					try:
+						out, err = proc.communicate(timeout=self.timeout)
+					except TimeoutExpired:
+						proc.kill()
+						proc.communicate()
+						raise
+			finally:
+				with self.lock:
+					self.procs.discard(proc)
+		return proc.returncode, out, err
+
+	# Kills running unrar processes and doesn't start new ones
+	def stop(self):
+		with self.lock:
+			self.stopped = True
+			for proc in self.procs:
+				try:
+					proc.kill()
+				except OSError:
+					# Already finished
+					pass
+
+
+# Checks a single archive for password, using unrar library if available
+def archive_contains_password(lib, runner, file_path):
+	if lib:
+		return lib_contains_password(lib, file_path)
+	returncode, out, err = runner.run(file_path)
+	# With "-p-" unrar doesn't prompt for password of encrypted headers but fails with RARX_BADPWD
+	if returncode == RARX_BADPWD:
+		return True
+	# Encrypted files in not encrypted archive are only shown in the listing
+	return check_passwordstrings(out, err)
+
+
+# Checks if file is worth testing: has a rar-extension or starts with rar signature
+# (obfuscated names, ".001" splits)
+def is_rar_candidate(file_path):
+	if rar_ext_regex.search(file_path):
+		return True
+	with open(file_path, 'rb') as archive:
+		return archive.read(len(RAR_SIGNATURE)) == RAR_SIGNATURE
+
+
+# Tests a single file, returns the file name and whether a password was found
+# (None if the test didn't complete in time)
+def probe_file(lib, runner, file, file_path):
+	try:
+		# Don't start unrar for par2, nfo, etc.
+		if not is_rar_candidate(file_path):
+			return file, False
+		return file, archive_contains_password(lib, runner, file_path)
+	except TimeoutExpired:
+		print('[WARNING] Testing %s timed out, will retry later' % file)
+		return file, None
+	except Exception as e:
+		print('[ERROR] Failed %s: %s' % (file, e))
+		if verbose:
+			traceback.print_exc()
+	return file, False
+
+
+# Reads option "ProbeTimeout", falls back to the default for invalid values
+def probe_timeout(default=30):
+	value = os.environ.get('NZBPO_PROBETIMEOUT', str(default))
+	try:
+		timeout = int(value)
+	except ValueError:
+		timeout = 0
+	if timeout <= 0:
+		print('[WARNING] Invalid ProbeTimeout "%s", using %i seconds' % (value, default))
+		return default
+	return timeout
+
+
+# Returns number of CPUs
+def cpu_count():
+	if PY2:
+		return multiprocessing.cpu_count()
+	# os.cpu_count returns None if undetermined
+	return os.cpu_count() or 1
+
+
+# Checks files for passwords without unpacking
+def contains_password(dir_name, tmp_file_name):
+	tested = load_tested(tmp_file_name)
+	files = get_latest_file(dir_name, tested)
+	signatures = dict((file, signature) for file, file_path, signature in files)
+	lib = load_unrar_lib()
+	# Resolve path to unrar once, not for every file
+	runner = None if lib else UnrarRunner([unrar(), 'l', '-p-', '-c-'], probe_timeout())
+	pool = None
+	# The unrar library keeps global error state which concurrent opens would share
+	# (false password reports), and header-only reads gain nothing from threads
+	if futures is None or lib or len(files) < 2:
+		results = (probe_file(lib, runner, file, file_path) for file, file_path, signature in files)
+	else:
+		# Most time is spent waiting for unrar processes and disk, test several files at once
+		pool = futures.ThreadPoolExecutor(max_workers=min(8, cpu_count()))
+		jobs = [pool.submit(probe_file, lib, runner, file, file_path) for file, file_path, signature in files]
+		results = (job.result() for job in futures.as_completed(jobs))
+	try:
+		for file, found in results:
+			if found:
+				return True
+			if found is None:
+				# Inconclusive, don't mark as tested
+				continue
+			tested[tested_key(file)] = signatures[file]
+		return False
+	finally:
+		# Stop remaining probes once a password is found: queued probes are cancelled
+		# and running unrar processes are killed, so the script doesn't wait for them
+		# on exit. Running libunrar calls can't be interrupted but only read headers.
+		if runner:
+			runner.stop()
+		if pool:
+			for job in jobs:
+				job.cancel()
+			pool.shutdown(wait=False)
+		# Save files tested so far on any exit, so the next event doesn't test them again
+		save_tested(tmp_file_name, tested)
 
 
 # Pause NZB group by API
@@ -300,9 +629,25 @@ def connect_to_nzbget():
 	return nzbget
 
 
+# HTTP sessions to NZBGet by connection info, so that calls reuse the connection
+nzbget_sessions = {}
+
+
+# Returns HTTP session for NZBGet, created on first use
+def nzbget_session(host, port, username, password):
+	key = (host, port, username, password)
+	if key not in nzbget_sessions:
+		session = requests.Session()
+		session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+		session.auth = (username, password)
+		nzbget_sessions[key] = session
+	return nzbget_sessions[key]
+
+
 # Connect to NZBGet and call an RPC-API-method without using of python's XML-RPC.
-# XML-RPC is easy to use but it is slow for large amount of data
-def call_nzbget_direct(url_command):
+# XML-RPC is easy to use but it is slow for large amount of data.
+# Returns the response or None if the call failed.
+def nzbget_request(url_command):
 	# First we need to know connection info: host, port and password of NZBGet server.
 	# NZBGet passes all configuration options to scripts as environment variables.
 	host = os.environ['NZBOP_CONTROLIP']
@@ -314,11 +659,57 @@ def call_nzbget_direct(url_command):
 	url = 'http://%s:%s/jsonrpc/%s' % ((host, '127.0.0.1')['0.0.0.0' == host], port, url_command)
 
 	try:
-		response = requests.get(url, auth=(username, password))
+		response = nzbget_session(host, port, username, password).get(url, timeout=30)
 	except requests.RequestException:
-		return ''
+		return None
+
+	return response if response.ok else None
+
+
+# Call an RPC-API-method, returns the raw json-string
+def call_nzbget_direct(url_command):
+	response = nzbget_request(url_command)
+	return ensure_str(response.content) if response is not None else ''
+
+
+# Call an RPC-API-method, returns the "result" of the json-rpc response.
+# The json is decoded straight from the response bytes. If that fails the
+# lines of the response are scanned using the given fallback parser.
+def call_nzbget_result(url_command, fallback_parser):
+	response = nzbget_request(url_command)
+	if response is None:
+		return []
+	try:
+		return json.loads(response.content)['result']
+	except (ValueError, KeyError, TypeError):
+		return fallback_parser(ensure_str(line) for line in response.iter_lines(decode_unicode=True))
 
-	return ensure_str(response.content) if response.ok else ''
+
+# Fallback parser for the result of "listfiles"
+def parse_listfiles_lines(lines):
+	files = []
+	cur_id = None
+	for line in lines:
+		if line.startswith(ID_PREFIX):
+			cur_id = int(line[len(ID_PREFIX):len(line)-1])
+		if line.startswith(FILENAME_PREFIX):
+			files.append({'ID': cur_id, 'Filename': line[len(FILENAME_PREFIX):len(line)-2]})
+	return files
+
+
+# Fallback parser for the result of "listgroups"
+def parse_listgroups_lines(lines):
+	groups = []
+	for line in lines:
+		if line.startswith(NZBID_PREFIX):
+			groups.append({'NZBID': int(line[len(NZBID_PREFIX):len(line)-1])})
+	return groups
+
+
+# Returns volume number XX of ".partXX.rar" or ".rXX" files, None for other files
+def rar_volume_number(file_name):
+	match = rar_num_regex.match(file_name)
+	return int(match.group('part') or match.group('r')) if match else None
 
 
 # Reorder inner files for earlier fake detection
@@ -327,31 +718,17 @@ def sort_inner_files():
 
 	# Building command-URL to call method "listfiles" passing three parameters: (0, 0, nzb_id)
 	url_command = 'listfiles?1=0&2=0&3=%i' % nzb_id
-	data = call_nzbget_direct(url_command)
-	
-	# The "data" is a raw json-string. We could use json.loads(data) to
-	# parse it but json-module is slow. We parse it on our own.
+	nzb_files = call_nzbget_result(url_command, parse_listfiles_lines)
 
-	# Iterate through the list of files to find the last rar-file.
+	# Find the last rar-file.
 	# The last is the one with the highest XX in ".partXX.rar" or ".rXX"
-	regex1 = re.compile(r'.*\.part(\d+)\.rar', re.IGNORECASE)
-	regex2 = re.compile(r'.*\.r(\d+)', re.IGNORECASE)
-	file_num = None
+	numbered = ((rar_volume_number(nzb_file['Filename']), nzb_file) for nzb_file in nzb_files)
+	rar_files = [(file_num, nzb_file) for file_num, nzb_file in numbered if file_num is not None]
 	file_id = None
-	file_name = None
-	
-	for line in data.splitlines():
-		if line.startswith('"ID" : '):
-			cur_id = int(line[7:len(line)-1])
-		if line.startswith('"Filename" : "'):
-			cur_name = line[14:len(line)-2]
-			match = regex1.match(cur_name) or regex2.match(cur_name)
-			if match:
-				cur_num = int(match.group(1))
-				if not file_num or cur_num > file_num:
-					file_num = cur_num
-					file_id = cur_id
-					file_name = cur_name
+	if rar_files:
+		last_file = max(rar_files, key=lambda rar_file: rar_file[0])[1]
+		file_id = last_file['ID']
+		file_name = last_file['Filename']
 
 	# Move the last rar-file to the top of file list
 	if file_id:
@@ -367,30 +744,24 @@ def sort_inner_files():
 
 
 # Remove current and any old temp files
-def clean_up():
+def clean_up(temp_folder):
 	nzb_id = os.environ.get('NZBPP_NZBID')
-	temp_folder = os.environ.get('NZBOP_TEMPDIR') + '/PasswordDetector'
 
-	nzbids = []
+	nzbids = set()
 	if os.path.isdir(temp_folder):
-		files = os.listdir(temp_folder)
+		files = [file for file, file_path, file_stat in list_files(temp_folder)]
 
 		if len(files) > 1:
 			# Create the list of nzbs in download queue
-			data = call_nzbget_direct('listgroups?1=0')
-			# The "data" is a raw json-string. We could use json.loads(data) to
-			# parse it but json-module is slow. We parse it on our own.
-			for line in data.splitlines():
-				if line.startswith('"NZBID" : '):
-					cur_id = int(line[10:len(line)-1])
-					nzbids.append(str(cur_id))
-
-		old_temp_files = list(set(files)-set(nzbids))
+			groups = call_nzbget_result('listgroups?1=0', parse_listgroups_lines)
+			nzbids = set(str(group['NZBID']) for group in groups)
+
+		old_temp_files = [file for file in files if file not in nzbids]
 		if nzb_id in files and nzb_id not in old_temp_files:
 			old_temp_files.append(nzb_id)
 
 		for temp_id in old_temp_files:
-			temp_file = temp_folder + '/' + str(temp_id)
+			temp_file = os.path.join(temp_folder, str(temp_id))
 			try:
 				print('[DETAIL] Removing temp file ' + temp_file)
 				os.remove(temp_file)
@@ -400,11 +771,11 @@ def clean_up():
 
 # Script body
 def main():
-	# Globally define directory for storing list of tested files
-	global tmp_file_name
+	# Directory for storing lists of tested files, one file per nzb
+	temp_folder = os.path.join(os.environ.get('NZBOP_TEMPDIR', ''), 'PasswordDetector')
 
 	# Do start up check
-	start_check()
+	start_check(temp_folder)
 	
 	# That's how we determine if the download is still runnning or is completely downloaded.
 	# We don't use this info in the fake detector (yet).
@@ -422,8 +793,8 @@ def main():
 	Directory = os.environ[Prefix + 'DIRECTORY']
 	NzbName = os.environ[Prefix + 'NZBNAME']
 	
-	# Directory for storing list of tested files
-	tmp_file_name = os.environ.get('NZBOP_TEMPDIR') + '/PasswordDetector/' + os.environ.get(Prefix + 'NZBID')
+	# File for storing list of tested files
+	tmp_file_name = os.path.join(temp_folder, os.environ[Prefix + 'NZBID'])
 	
 	# When nzb is added to queue - reorder inner files for earlier fake detection.
 	# Also it is possible that nzb was added with a category which doesn't have 
@@ -445,7 +816,7 @@ def main():
 	print('[DETAIL] Detecting password for %s' % NzbName)
 	sys.stdout.flush()
 	
-	if contains_password(Directory) is True:
+	if contains_password(Directory, tmp_file_name) is True:
 		print("[WARNING] Password found in %s" % NzbName)
 		# A password is detected
 		#
@@ -481,7 +852,7 @@ def main():
 	
 	# Remove temp files in PP
 	if Prefix == 'NZBPP_':
-		clean_up()
+		clean_up(temp_folder)
 
 
 # Execute main script function